@@ -1,15 +1,278 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 import json
 import os
 import glob
 import gspread
 import io
+import time
+import random
+import functools
+import hmac
+import hashlib
+import threading
+import uuid
+from collections import deque
+from itertools import islice
 
 # --- Page Setup ---
 st.set_page_config(page_title="Warehouse Inventory", page_icon="📦", layout="centered")
 
+# --- Cloud Connection ---
+SPREADSHEET_NAME = "Warehouse Live Sync"
+DICT_HEADER = ["Category", "Model"]
+USERS_HEADER = ["Username", "Password"]
+AUDIT_HEADER = ["Audit Trail"]
+
+# Google answers bursts with 429/5xx; these are worth waiting out instead of failing the click
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# A 5xx on an append may still have landed on Google's side, retrying it would add the rows twice
+APPEND_RETRY_STATUSES = (429,)
+MAX_RETRIES = 4
+
+# Google allows 60 requests a minute per user, keep a little under it across every open session
+SHEETS_REQUESTS_PER_MINUTE = 55
+
+@st.cache_resource
+def sheets_rate_limiter():
+    return {"tokens": float(SHEETS_REQUESTS_PER_MINUTE), "updated": time.monotonic(), "lock": threading.Lock()}
+
+def acquire_sheets_token():
+    # Token bucket: a burst waits its turn here instead of getting a 429 back from Google
+    bucket = sheets_rate_limiter()
+    rate = SHEETS_REQUESTS_PER_MINUTE / 60
+    with bucket["lock"]:
+        now = time.monotonic()
+        bucket["tokens"] = min(SHEETS_REQUESTS_PER_MINUTE, bucket["tokens"] + (now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        bucket["tokens"] -= 1 # Claim the token now so whoever is queued behind us waits longer
+        wait = -bucket["tokens"] / rate if bucket["tokens"] < 0 else 0
+    if wait:
+        time.sleep(wait)
+
+def sheets_request(fn, *args, **kwargs):
+    # Every call that goes out to Google takes a token, so helpers that make several calls pay for each one
+    acquire_sheets_token()
+    return fn(*args, **kwargs)
+
+def retry_sheets(fn=None, statuses=RETRY_STATUSES):
+    if fn is None:
+        return functools.partial(retry_sheets, statuses=statuses)
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except gspread.exceptions.APIError as e:
+                status = e.response.status_code # e.code is -1 when Google sends back an HTML error page
+                if status not in statuses or attempt == MAX_RETRIES:
+                    raise
+                # If Google says how long to back off, trust it over our own guess
+                retry_after = e.response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = int(retry_after)
+                else:
+                    delay = 2 ** attempt + random.uniform(0, 0.5)
+                time.sleep(min(30, delay))
+    return wrapper
+
+@st.cache_resource
+def get_spreadsheet():
+    # Logging in to Google is the slowest part of every cloud call, so do it once for every session to share
+    credentials = dict(st.secrets["gcp_service_account"])
+    gc = gspread.service_account_from_dict(credentials)
+    return sheets_request(gc.open, SPREADSHEET_NAME)
+
+def get_worksheet(title, header, rows="1000"):
+    # Remember each tab after the first lookup so writes are a single append call
+    if 'worksheets' not in st.session_state:
+        st.session_state.worksheets = {}
+    if title not in st.session_state.worksheets:
+        sh = get_spreadsheet()
+        try:
+            ws = sheets_request(sh.worksheet, title)
+            if len(sheets_request(ws.row_values, 1)) < len(header):
+                sheets_request(ws.insert_row, header, index=1)
+        except gspread.exceptions.WorksheetNotFound:
+            ws = sheets_request(sh.add_worksheet, title=title, rows=rows, cols=str(len(header)))
+            sheets_request(ws.update, [header])
+        st.session_state.worksheets[title] = ws
+    return st.session_state.worksheets[title]
+
+# Every new session reads the same Users/Dictionary tabs, so share one copy for a minute instead of hitting Google each time
+READ_CACHE_SECONDS = 60
+
+@st.cache_data(ttl=READ_CACHE_SECONDS, show_spinner=False)
+def fetch_sheet_records(title, header, rows="1000", version=0):
+    # Streamlit only lets one session fill a missing entry at a time, the rest wait and then get the fresh copy.
+    # One attempt per fill, so a backoff never keeps the others waiting
+    # Everything we read is text, skipping the number guessing also keeps zeros on "007" style models and passwords
+    return sheets_request(get_worksheet(title, header, rows).get_all_records, numericise_ignore=["all"])
+
+@st.cache_resource
+def sheet_versions():
+    # Bumped per tab on every write, so a write only retires the cached copy of the tab it touched
+    return {}
+
+@st.cache_resource
+def sheet_rewrites():
+    # Bumped per tab when rows are deleted or rewritten, which shifts row numbers under every session's reload offset
+    return {}
+
+@retry_sheets
+def read_sheet_records(title, header, rows="1000"):
+    return fetch_sheet_records(title, header, rows, sheet_versions().get(title, 0))
+
+# A copy of the Dictionary on disk, so a server restart doesn't have to start by asking Google
+DICT_MIRROR_FILE = "dictionary_mirror.json"
+DICT_MIRROR_SECONDS = 300
+
+@st.cache_resource
+def server_run_id():
+    return uuid.uuid4().hex
+
+def read_dictionary_records():
+    version = sheet_versions().get("Dictionary", 0)
+    try:
+        if time.time() - os.path.getmtime(DICT_MIRROR_FILE) < DICT_MIRROR_SECONDS:
+            with open(DICT_MIRROR_FILE, "r") as f:
+                mirror = json.load(f)
+            # Within this run the mirror only counts if nobody wrote to the Dictionary since it was taken,
+            # one left by an earlier run was current when that run stopped
+            if mirror["run"] != server_run_id() or mirror["version"] == version:
+                return mirror["records"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass # Missing, old-format or half-written mirror, just go to the cloud
+    records = read_sheet_records("Dictionary", DICT_HEADER)
+    if sheet_versions().get("Dictionary", 0) == version: # Skip saving if a write landed while we were reading
+        # Written next to the real file and swapped in, so nobody reads it half-written
+        tmp_file = f"{DICT_MIRROR_FILE}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"run": server_run_id(), "version": version, "records": records}, f)
+        os.replace(tmp_file, DICT_MIRROR_FILE)
+    return records
+
+def forget_cached_reads(title, rows_shifted=False):
+    versions = sheet_versions()
+    versions[title] = versions.get(title, 0) + 1
+    if rows_shifted:
+        rewrites = sheet_rewrites()
+        rewrites[title] = rewrites.get(title, 0) + 1
+    if title == "Dictionary":
+        try:
+            os.remove(DICT_MIRROR_FILE)
+        except FileNotFoundError:
+            pass
+
+@retry_sheets(statuses=APPEND_RETRY_STATUSES)
+def append_sheet_rows(title, header, new_rows):
+    sheets_request(get_worksheet(title, header).append_rows, new_rows, value_input_option="RAW")
+    forget_cached_reads(title) # The cached copy is stale now
+
+@retry_sheets(statuses=APPEND_RETRY_STATUSES)
+def append_rows_to_sheets(appends):
+    # Several tabs' appends ride in one batchUpdate call instead of one round trip per tab
+    requests = []
+    for title, header, new_rows in appends:
+        if new_rows:
+            cells = [{"values": [{"userEnteredValue": {"stringValue": str(v)}} for v in row]} for row in new_rows]
+            requests.append({"appendCells": {"sheetId": get_worksheet(title, header).id, "rows": cells, "fields": "userEnteredValue"}})
+    if requests:
+        sheets_request(get_spreadsheet().batch_update, {"requests": requests})
+    for title, _, new_rows in appends:
+        if new_rows:
+            forget_cached_reads(title)
+
+@retry_sheets
+def replace_sheet_rows(title, header, new_rows):
+    ws = get_worksheet(title, header)
+    sheets_request(ws.clear)
+    sheets_request(ws.update, [header] + new_rows)
+    forget_cached_reads(title, rows_shifted=True)
+
+@retry_sheets
+def delete_sheet_rows(title, header, value, column=1):
+    # Only the matching rows get removed, instead of wiping the tab and uploading every other row again
+    ws = get_worksheet(title, header)
+    row_numbers = sorted({c.row for c in sheets_request(ws.findall, value, in_column=column) if c.row > 1}, reverse=True)
+    if row_numbers:
+        # Bottom rows first so the row numbers above them don't shift
+        requests = [{"deleteDimension": {"range": {"sheetId": ws.id, "dimension": "ROWS", "startIndex": r - 1, "endIndex": r}}} for r in row_numbers]
+        sheets_request(get_spreadsheet().batch_update, {"requests": requests})
+    forget_cached_reads(title, rows_shifted=True)
+
+@retry_sheets
+def read_sheet_range(title, header, cell_range):
+    return sheets_request(get_worksheet(title, header).get, cell_range)
+
+def push_dictionary():
+    dict_rows = [[c, m_val] for c, models_in_cat in st.session_state.cloud_models.items() for m_val in models_in_cat]
+    replace_sheet_rows("Dictionary", DICT_HEADER, dict_rows)
+
+# --- Cloud Write Buffer ---
+# Audit rows wait here so a burst of scans goes to Google as one append instead of one call per click
+FLUSH_EVERY_ROWS = 10
+FLUSH_EVERY_SECONDS = 5
+COALESCE_SECONDS = 5
+
+def mark_audit_flushed():
+    st.session_state.pending_rows = []
+    st.session_state.audit_merge = None
+
+def queue_audit_row(entry):
+    st.session_state.pending_rows.append([entry])
+    st.session_state.audit_merge = None
+
+def queue_count_audit(merge_key, qty, make_entry):
+    # Scanning the same model into the same spot over and over becomes one summed row instead of a row per click
+    merge = st.session_state.get('audit_merge')
+    now = time.monotonic()
+    if merge and merge["key"] == merge_key and st.session_state.pending_rows and now - merge["started"] < COALESCE_SECONDS:
+        merge["qty"] += qty
+        merge["make_entry"] = make_entry
+        st.session_state.pending_rows[-1] = [make_entry(merge["qty"])]
+    else:
+        queue_audit_row(make_entry(qty))
+        st.session_state.audit_merge = {"key": merge_key, "qty": qty, "started": now, "make_entry": make_entry}
+
+def unqueue_count_audit(merge_key, qty):
+    # Undoing a click whose row hasn't reached Google yet just takes it back out of the queue
+    merge = st.session_state.get('audit_merge')
+    if not (merge and merge["key"] == merge_key and st.session_state.pending_rows and merge["qty"] >= qty):
+        return False
+    merge["qty"] -= qty
+    if merge["qty"]:
+        st.session_state.pending_rows[-1] = [merge["make_entry"](merge["qty"])]
+    else:
+        st.session_state.pending_rows.pop()
+        st.session_state.audit_merge = None
+    return True
+
+def flush_pending(force=False):
+    pending = st.session_state.get('pending_rows')
+    if not pending:
+        return
+    # A row that's still collecting repeat scans waits until its window closes, otherwise the first scan of a burst goes out alone
+    merge = st.session_state.get('audit_merge')
+    hold_last = not force and merge is not None and time.monotonic() - merge["started"] < COALESCE_SECONDS
+    rows = pending[:-1] if hold_last else pending
+    if not rows:
+        return
+    # monotonic so a clock change on the tablet can't stall or spam the flush
+    if not force and len(pending) < FLUSH_EVERY_ROWS and time.monotonic() - st.session_state.last_flush < FLUSH_EVERY_SECONDS:
+        return
+    try:
+        append_sheet_rows("Audit Log", AUDIT_HEADER, rows)
+        if hold_last:
+            st.session_state.pending_rows = pending[-1:]
+        else:
+            mark_audit_flushed()
+    except Exception:
+        pass # Keep the rows queued, the next flush will try again
+    st.session_state.last_flush = time.monotonic()
+
 # --- USER ACCOUNTS ---
 # Securely load the indestructible Master accounts from Streamlit's hidden vault
 if 'USERS' not in st.session_state:
@@ -22,20 +285,12 @@ if 'USERS' not in st.session_state:
         
     # Pull dynamic worker accounts from the Cloud "Users" tab
     try:
-        credentials = dict(st.secrets["gcp_service_account"])
-        gc = gspread.service_account_from_dict(credentials)
-        sh = gc.open("Warehouse Live Sync")
-        try:
-            users_sheet = sh.worksheet("Users")
-            cloud_users = users_sheet.get_all_records()
-            for row in cloud_users:
-                u = str(row.get("Username", "")).strip()
-                p = str(row.get("Password", "")).strip()
-                if u and p:
-                    st.session_state.USERS[u] = p
-        except gspread.exceptions.WorksheetNotFound:
-            users_sheet = sh.add_worksheet(title="Users", rows="100", cols="2")
-            users_sheet.update([["Username", "Password"]])
+        cloud_users = read_sheet_records("Users", USERS_HEADER, rows="100")
+        for row in cloud_users:
+            u = str(row.get("Username", "")).strip()
+            p = str(row.get("Password", "")).strip()
+            if u and p:
+                st.session_state.USERS[u] = p
     except Exception:
         pass # Fail silently if internet is down, Master Admin can still log in
 
@@ -53,7 +308,12 @@ if not st.session_state.authenticated:
     pwd_guess = st.text_input("Password", type="password")
     
     if st.button("Login", type="primary"):
-        if username_guess in st.session_state.USERS and st.session_state.USERS[username_guess] == pwd_guess:
+        # Constant-time compare so response timing doesn't reveal how much of the password matched;
+        # comparing fixed-size digests also hides how long the stored password is
+        stored_pwd = str(st.session_state.USERS.get(username_guess, ""))
+        stored_digest = hashlib.sha256(stored_pwd.encode()).digest()
+        guess_digest = hashlib.sha256(pwd_guess.encode()).digest()
+        if username_guess in st.session_state.USERS and hmac.compare_digest(stored_digest, guess_digest):
             st.session_state.authenticated = True
             st.session_state.current_user = username_guess
             st.rerun()
@@ -67,12 +327,55 @@ if not st.session_state.authenticated:
 # ==========================================
 
 # --- Local Database Configuration ---
+# Only the most recent actions are kept for Undo and the history log, so a long shift can't grow memory forever
+HISTORY_LIMIT = 1000
+
 def get_data_file():
     return f"inventory_data_{st.session_state.current_user}.json"
 
 def get_hist_file():
     return f"inventory_history_{st.session_state.current_user}.json"
 
+def read_history_file(hist_file):
+    # One JSON entry per line, so new actions can be appended without rewriting the whole log.
+    # Also says whether the file is still in the old single-list format and needs rewriting before the next append.
+    with open(hist_file, 'r') as f:
+        text = f.read()
+    try:
+        parsed = json.loads(text)
+        if isinstance(parsed, list):
+            return [i for i in parsed if isinstance(i, dict)], True
+        return ([parsed] if parsed else []), False
+    except ValueError:
+        pass
+    
+    # A line can hold more than one value when an entry was appended straight onto an old list, so decode them one by one
+    decoder = json.JSONDecoder()
+    history = []
+    legacy = False
+    for line in text.splitlines():
+        pos = 0
+        while pos < len(line):
+            try:
+                item, pos = decoder.raw_decode(line, pos)
+            except ValueError:
+                break
+            if isinstance(item, dict):
+                history.append(item)
+            elif isinstance(item, list):
+                history.extend(i for i in item if isinstance(i, dict))
+                legacy = True
+            while pos < len(line) and line[pos].isspace():
+                pos += 1
+    return history, legacy
+
+def decode_counts(raw_data):
+    # Files keep "model|location" strings; in memory each count is keyed by a (model, location) tuple
+    return {tuple(k.rsplit("|", 1)): v for k, v in raw_data.items() if "|" in k}
+
+def encode_counts(data):
+    return {f"{m}|{l}": v for (m, l), v in data.items()}
+
 def load_local_db():
     data_file = get_data_file()
     hist_file = get_hist_file()
@@ -80,92 +383,226 @@ def load_local_db():
     if 'data' not in st.session_state:
         if os.path.exists(data_file):
             with open(data_file, 'r') as f:
-                st.session_state.data = json.load(f)
+                st.session_state.data = decode_counts(json.load(f))
         else:
             st.session_state.data = {}
+        st.session_state.data_token = uuid.uuid4().hex
 
     if 'history' not in st.session_state:
         if os.path.exists(hist_file):
-            with open(hist_file, 'r') as f:
-                st.session_state.history = json.load(f)
+            items, legacy = read_history_file(hist_file)
+            st.session_state.history = deque(items, maxlen=HISTORY_LIMIT)
+            if legacy:
+                write_history_file(hist_file, items) # Every entry, the file stays the full record
         else:
-            st.session_state.history = []
+            st.session_state.history = deque(maxlen=HISTORY_LIMIT)
+
+def write_history_file(hist_file, items):
+    with open(hist_file, 'w') as f:
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+
+def drop_last_history_entry(hist_file):
+    # Undo takes the newest line back off the end, entries older than what's kept in memory stay in the file
+    try:
+        with open(hist_file, 'rb+') as f:
+            text = f.read().rstrip(b"\r\n")
+            f.truncate(text.rfind(b"\n") + 1)
+    except FileNotFoundError:
+        pass
 
-def save_local_db():
+def save_local_db(new_history_item=None):
     data_file = get_data_file()
     hist_file = get_hist_file()
     
     with open(data_file, 'w') as f:
-        json.dump(st.session_state.data, f)
-    with open(hist_file, 'w') as f:
-        json.dump(st.session_state.history, f)
+        json.dump(encode_counts(st.session_state.data), f)
+    # Every change to the counts comes through here, so a fresh token is all the report cache needs to notice
+    st.session_state.data_token = uuid.uuid4().hex
+    if new_history_item is not None:
+        # Normal clicks only add one line to the end of the history file
+        with open(hist_file, 'a') as f:
+            f.write(json.dumps(new_history_item) + "\n")
+        
+    # Keep the cached copy of everyone's files in step with our own file without re-reading it
+    if 'all_user_data' in st.session_state:
+        st.session_state.all_user_data[data_file] = st.session_state.data
+        st.session_state.all_user_data_token = uuid.uuid4().hex
+        st.session_state.all_user_data_versions[data_file] = st.session_state.all_user_data_token
+        if 'all_user_data_files' in st.session_state:
+            stat = os.stat(data_file)
+            st.session_state.all_user_data_files[data_file] = (stat.st_mtime_ns, stat.st_size)
+
+# --- Shared View of Every User's Counts ---
+ALL_USER_DATA_TTL_SECONDS = 60
+
+def user_files_signature():
+    # Modified time and size of every workspace file, a cheap way to tell whether anything changed on disk
+    signature = {}
+    for file in glob.glob("inventory_data_*.json"):
+        try:
+            stat = os.stat(file)
+            signature[file] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            pass
+    return signature
+
+def load_all_user_data():
+    # Reading every user's file on every rerun is slow, so keep a copy for a minute at a time
+    age = time.time() - st.session_state.get('all_user_data_mtime', 0)
+    if 'all_user_data_versions' not in st.session_state or age >= ALL_USER_DATA_TTL_SECONDS:
+        signature = user_files_signature()
+        # Nothing changed on disk: keep the copy and its token so the reports stay cached too
+        if 'all_user_data_versions' not in st.session_state or signature != st.session_state.get('all_user_data_files'):
+            old_signature = st.session_state.get('all_user_data_files') or {}
+            old_data = st.session_state.get('all_user_data', {})
+            old_versions = st.session_state.get('all_user_data_versions', {})
+            token = uuid.uuid4().hex
+            all_user_data, versions = {}, {}
+            for file, file_sig in signature.items():
+                # Only files that changed since the last look get read again
+                if file in old_data and old_signature.get(file) == file_sig:
+                    all_user_data[file], versions[file] = old_data[file], old_versions[file]
+                    continue
+                try:
+                    with open(file, "r") as f:
+                        all_user_data[file] = decode_counts(json.load(f))
+                    versions[file] = token
+                except:
+                    pass
+            st.session_state.all_user_data = all_user_data
+            st.session_state.all_user_data_versions = versions
+            st.session_state.all_user_data_files = signature
+            st.session_state.all_user_data_token = token
+        st.session_state.all_user_data_mtime = time.time()
+    return st.session_state.all_user_data
+
+def invalidate_all_user_data():
+    st.session_state.all_user_data_mtime = 0
+    st.session_state.pop('all_user_data_files', None)
+
+def master_totals():
+    # Running totals over every workspace; a changed file takes its old counts back out and adds its new ones,
+    # so one worker's edit costs that worker's rows instead of a re-sum of everybody
+    all_user_data = load_all_user_data()
+    versions = st.session_state.all_user_data_versions
+    memo = st.session_state.setdefault('master_totals', {"versions": {}, "parts": {}, "totals": {}})
+    totals = memo["totals"]
+    for file in list(memo["parts"]):
+        if versions.get(file) != memo["versions"][file]:
+            for k, v in memo["parts"].pop(file).items():
+                totals[k] -= v
+            del memo["versions"][file]
+    for file, counts in all_user_data.items():
+        if file not in memo["parts"]:
+            memo["parts"][file] = dict(counts) # A copy, our own counts keep changing in place
+            memo["versions"][file] = versions[file]
+            for k, v in counts.items():
+                totals[k] = totals.get(k, 0) + v
+    return totals
 
 # Initialize the database on startup
 load_local_db()
 
+if 'pending_rows' not in st.session_state:
+    st.session_state.pending_rows = []
+    st.session_state.last_flush = time.monotonic()
+
 # --- Cloud Dictionary Integration (Categories & Models) ---
 # Force Streamlit to forget the old memory structure if it's still holding onto it!
 if 'cloud_models' in st.session_state and not isinstance(st.session_state.cloud_models, dict):
     del st.session_state.cloud_models
 
+# Reload only pulls rows added since the last read, with a full read this often to catch deleted rows
+DICT_FULL_READ_SECONDS = 300
+
+def read_dictionary_delta():
+    seen = st.session_state.dict_rows_seen
+    new_rows = read_sheet_range("Dictionary", DICT_HEADER, f"A{seen + 2}:B") # +2 skips the header row
+    for row in new_rows:
+        c = str(row[0]).strip() if len(row) > 0 else ""
+        m = str(row[1]).strip() if len(row) > 1 else ""
+        if c and m:
+            # Same rule as the full load, the newest row for a model wins
+            for models in st.session_state.cloud_models.values():
+                models.discard(m)
+            st.session_state.cloud_models.setdefault(c, set()).add(m)
+    for c in [c for c, models in st.session_state.cloud_models.items() if not models and c != "Apk"]:
+        del st.session_state.cloud_models[c]
+    st.session_state.dict_rows_seen = seen + len(new_rows)
+
 if 'cloud_models' not in st.session_state:
     st.session_state.cloud_models = {}
     if st.session_state.authenticated:
         try:
-            credentials = dict(st.secrets["gcp_service_account"])
-            gc = gspread.service_account_from_dict(credentials)
-            sh = gc.open("Warehouse Live Sync")
-            try:
-                dict_sheet = sh.worksheet("Dictionary")
-                records = dict_sheet.get_all_records()
-                
-                # Removed the aggressive intercept! All categories are allowed now.
-                latest_mapping = {}
-                for row in records:
-                    c = str(row.get("Category", "")).strip()
-                    m = str(row.get("Model", "")).strip()
-                    if c and m:
-                        latest_mapping[m] = c 
-                        
-                for m, c in latest_mapping.items():
-                    if c not in st.session_state.cloud_models:
-                        st.session_state.cloud_models[c] = set()
-                    st.session_state.cloud_models[c].add(m)
-            except gspread.exceptions.WorksheetNotFound:
-                pass 
+            # Taken before reading, so a rewrite that lands mid-read still forces the next reload to read it all
+            rewrites_seen = sheet_rewrites().get("Dictionary", 0)
+            records = read_dictionary_records()
+            st.session_state.dict_rewrites_seen = rewrites_seen
+            st.session_state.dict_rows_seen = len(records)
+            st.session_state.dict_full_read_at = time.monotonic()
+            
+            # Removed the aggressive intercept! All categories are allowed now.
+            latest_mapping = {}
+            for row in records:
+                c = str(row.get("Category", "")).strip()
+                m = str(row.get("Model", "")).strip()
+                if c and m:
+                    latest_mapping[m] = c 
+                    
+            for m, c in latest_mapping.items():
+                if c not in st.session_state.cloud_models:
+                    st.session_state.cloud_models[c] = set()
+                st.session_state.cloud_models[c].add(m)
         except Exception:
             pass 
 
+# --- Catalog Lists ---
+MODEL_PLACEHOLDER = "-- Select Existing Model --"
+SELECT_PLACEHOLDER = "-- Select --"
+ADD_CATEGORY_OPTION = "➕ Add New Category"
+
+def get_catalog():
+    # The sorted dropdown lists only change when the dictionary does, so build them once per change
+    if 'catalog' not in st.session_state:
+        model_to_cat = {}
+        for cat, models in st.session_state.cloud_models.items():
+            for m in models:
+                model_to_cat[m] = cat
+        categories = sorted(st.session_state.cloud_models.keys())
+        models_by_cat = {cat: sorted(models) for cat, models in st.session_state.cloud_models.items()}
+        all_models = sorted(model_to_cat)
+        st.session_state.catalog = {
+            "categories": categories,
+            "models_by_cat": models_by_cat,
+            "all_models": all_models,
+            "model_to_cat": model_to_cat,
+            "token": uuid.uuid4().hex,
+            # Ready-made dropdown option tuples, so reruns don't rebuild them
+            "admin_category_options": (*categories, ADD_CATEGORY_OPTION),
+            "model_options_by_cat": {cat: (MODEL_PLACEHOLDER, *models) for cat, models in models_by_cat.items()},
+            "model_pick_options": (SELECT_PLACEHOLDER, *all_models),
+            "category_pick_options": (SELECT_PLACEHOLDER, *categories),
+            "deletable_category_options": (SELECT_PLACEHOLDER, *(c for c in categories if c != "Apk")),
+        }
+    return st.session_state.catalog
+
+def invalidate_catalog():
+    st.session_state.pop('catalog', None)
+
 # Force "Apk" to exist as the master default
 if "Apk" not in st.session_state.cloud_models:
     st.session_state.cloud_models["Apk"] = set()
+    invalidate_catalog()
 
-# Sweep legacy local data to ensure it gets assigned to Apk
-for file in glob.glob("inventory_data_*.json"):
-    try:
-        with open(file, "r") as f:
-            user_data = json.load(f)
-            for k in user_data.keys():
-                m = k.split("|")[0]
-                found = False
-                for cat, models in st.session_state.cloud_models.items():
-                    if m in models:
-                        found = True
-                        break
-                if not found:
-                    st.session_state.cloud_models["Apk"].add(m)
-    except:
-        pass
-
-for k in st.session_state.data.keys():
-    m = k.split("|")[0]
-    found = False
-    for cat, models in st.session_state.cloud_models.items():
-        if m in models:
-            found = True
-            break
-    if not found:
-        st.session_state.cloud_models["Apk"].add(m)
+# Sweep legacy local data to ensure it gets assigned to Apk (every workspace, plus our own unsaved counts)
+# One set difference instead of checking every counted model against every category
+known_models = set().union(*st.session_state.cloud_models.values())
+counted_models = {m for user_data in [*load_all_user_data().values(), st.session_state.data] for m, _ in user_data.keys()}
+orphan_models = counted_models - known_models
+if orphan_models:
+    st.session_state.cloud_models["Apk"].update(orphan_models)
+    invalidate_catalog()
 
 # --- Header ---
 colA, colB = st.columns([4, 1])
@@ -173,54 +610,89 @@ with colA:
     st.title(f"📦 Workspace: {st.session_state.current_user}")
 with colB:
     if st.button("Logout", key="logout_btn"):
+        flush_pending(force=True)
         st.session_state.authenticated = False
         st.session_state.current_user = None
         if 'data' in st.session_state: del st.session_state.data
         if 'history' in st.session_state: del st.session_state.history
         st.rerun()
+    if st.button("🔄 Reload", key="reload_btn", help="Pull the latest categories and models from the cloud"):
+        last_full = st.session_state.get('dict_full_read_at')
+        # Any session deleting or rewriting Dictionary rows moves them, so our row offset is only good if none did
+        rows_shifted = sheet_rewrites().get("Dictionary", 0) != st.session_state.get('dict_rewrites_seen')
+        if last_full is None or rows_shifted or time.monotonic() - last_full > DICT_FULL_READ_SECONDS:
+            forget_cached_reads("Dictionary")
+            del st.session_state.cloud_models
+        else:
+            try:
+                read_dictionary_delta()
+            except Exception as e:
+                st.toast(f"⚠️ Couldn't reach the cloud dictionary: {e}")
+        invalidate_catalog()
+        st.rerun()
 
 st.markdown("---")
 
 # --- Input Area (2-Step Categorized UI) ---
 st.write("**Add / Remove / Move Inventory**")
 
-categories = sorted(list(st.session_state.cloud_models.keys()))
+# Fixed dropdown choices are built once as tuples instead of as fresh lists on every rerun
+LOCATIONS = ("Warehouse", "Assembly", "Suspect")
+DESTINATIONS = ("Assembly", "Warehouse", "Suspect")
+
+catalog = get_catalog()
+categories = catalog["categories"]
 
-cat_col, mod_col = st.columns(2)
+# Category stays outside the form so picking one refreshes the model list right away
+cat_col, new_cat_col = st.columns(2)
 with cat_col:
-    cat_options = categories.copy()
     if st.session_state.current_user == "Admin":
-        cat_options.append("➕ Add New Category")
+        cat_options = catalog["admin_category_options"]
+    else:
+        cat_options = categories
         
     selected_cat = st.selectbox("Category", cat_options)
-    if selected_cat == "➕ Add New Category":
+with new_cat_col:
+    if selected_cat == ADD_CATEGORY_OPTION:
         actual_cat = st.text_input("New Category Name").strip()
     else:
         actual_cat = selected_cat
 
-with mod_col:
-    if actual_cat and actual_cat in st.session_state.cloud_models:
-        cat_models = sorted(list(st.session_state.cloud_models[actual_cat]))
-    else:
-        cat_models = []
-        
-    selected_mod = st.selectbox("Model Selection", ["-- Select Existing Model --", "➕ ADD NEW MODEL"] + cat_models)
-    if selected_mod == "➕ ADD NEW MODEL" or selected_mod == "-- Select Existing Model --":
-        actual_mod = st.text_input("Type New Model Number").upper().strip()
-    else:
-        actual_mod = selected_mod
-
-# Lock in the final model
-model = actual_mod
+model_options = catalog["model_options_by_cat"].get(actual_cat, (MODEL_PLACEHOLDER,))
 
-# The UI for quantities, locations, and transfers
-qty_col, loc_col, dest_col = st.columns(3)
-with qty_col:
-    qty = st.number_input("Quantity", min_value=1, step=1, value=1)
+# Locations stay outside the form too, clearing the form after each action shouldn't move the next scan somewhere else
+loc_col, dest_col = st.columns(2)
 with loc_col:
-    loc = st.selectbox("Location (Add/Sub/From)", ["Warehouse", "Assembly", "Suspect"])
+    loc = st.selectbox("Location (Add/Sub/From)", LOCATIONS)
 with dest_col:
-    to_loc = st.selectbox("Destination (Moves Only)", ["Assembly", "Warehouse", "Suspect"])
+    to_loc = st.selectbox("Destination (Moves Only)", DESTINATIONS)
+
+# Everything else lives in a form, so typing and picking doesn't rerun the app until a button is pressed.
+# Enter doesn't submit, a scanner's Enter after a code would otherwise always count as ADD
+with st.form("entry", clear_on_submit=True, enter_to_submit=False):
+    sel_col, new_mod_col, qty_col = st.columns(3)
+    with sel_col:
+        selected_mod = st.selectbox("Model Selection", model_options)
+    with new_mod_col:
+        typed_mod = st.text_input("Type New Model Number", help="Leave blank to use the selected model").upper().strip()
+    with qty_col:
+        qty = st.number_input("Quantity", min_value=1, step=1, value=1)
+
+    btn_col1, btn_col2, btn_col3 = st.columns(3)
+    with btn_col1:
+        add_clicked = st.form_submit_button("ADD (+)", use_container_width=True, type="primary")
+    with btn_col2:
+        sub_clicked = st.form_submit_button("SUB (-)", use_container_width=True)
+    with btn_col3:
+        move_clicked = st.form_submit_button("MOVE (⇆)", use_container_width=True)
+
+# Lock in the final model, a typed number wins over the dropdown
+if typed_mod:
+    model = typed_mod
+elif selected_mod != MODEL_PLACEHOLDER:
+    model = selected_mod
+else:
+    model = ""
 
 # --- Math & Logic Functions ---
 def modify_inventory(direction):
@@ -231,7 +703,7 @@ def modify_inventory(direction):
         st.error("Please select or enter a Category.")
         return
         
-    key = f"{model}|{loc}"
+    key = (model, loc)
     if key not in st.session_state.data:
         st.session_state.data[key] = 0
         
@@ -241,7 +713,7 @@ def modify_inventory(direction):
             st.warning("Source and destination cannot be the same!")
             return
             
-        key_to = f"{model}|{to_loc}"
+        key_to = (model, to_loc)
         if key_to not in st.session_state.data:
             st.session_state.data[key_to] = 0
             
@@ -253,63 +725,53 @@ def modify_inventory(direction):
         st.session_state.data[key] += change
         action_word = "Added" if direction == "add" else "Removed"
     
-    st.session_state.history.append({
+    # One clock read formats both the history and audit timestamps, without building a datetime
+    now_struct = time.localtime()
+    history_item = {
         "action": action_word,
         "model": model,
         "qty": qty,
         "loc": loc,
         "to_loc": to_loc if direction == "move" else None,
-        "key": key,
-        "key_to": key_to if direction == "move" else None,
-        "timestamp": datetime.now().strftime("%H:%M:%S")
-    })
+        "timestamp": time.strftime("%H:%M:%S", now_struct)
+    }
+    st.session_state.history.append(history_item)
+    
+    save_local_db(new_history_item=history_item)
+    
+    # Audit Log Update (queued, see flush_pending)
+    full_timestamp = time.strftime("%Y-%m-%d %I:%M %p", now_struct)
+    def make_entry(total_qty):
+        if direction == "move":
+            return f"[{full_timestamp}] {st.session_state.current_user} MOVED {total_qty} of Model {model} (From: {loc} ➔ To: {to_loc})"
+        return f"[{full_timestamp}] {st.session_state.current_user} {action_word.upper()} {total_qty} of Model {model} (Location: {loc})"
     
-    save_local_db()
+    queue_count_audit((direction, model, loc, to_loc if direction == "move" else None), qty, make_entry)
     
     # --- AUTO-CLOUD PUSH ---
-    try:
-        credentials = dict(st.secrets["gcp_service_account"])
-        gc = gspread.service_account_from_dict(credentials)
-        sh = gc.open("Warehouse Live Sync")
-        
-        # Dictionary Update
-        is_new = True
-        if actual_cat in st.session_state.cloud_models:
-            if model in st.session_state.cloud_models[actual_cat]:
-                is_new = False
-                
-        if is_new:
-            if actual_cat not in st.session_state.cloud_models:
-                st.session_state.cloud_models[actual_cat] = set()
-            st.session_state.cloud_models[actual_cat].add(model)
-            
-            try:
-                dict_sheet = sh.worksheet("Dictionary")
-                if len(dict_sheet.row_values(1)) < 2:
-                    dict_sheet.insert_row(["Category", "Model"], index=1)
-            except gspread.exceptions.WorksheetNotFound:
-                dict_sheet = sh.add_worksheet(title="Dictionary", rows="1000", cols="2")
-                dict_sheet.update([["Category", "Model"]])
-            
-            dict_sheet.append_row([actual_cat, model])
-            st.toast(f"☁️ '{model}' instantly saved to category '{actual_cat}'!")
-            
-        # Audit Log Update
-        try:
-            audit_sheet = sh.worksheet("Audit Log")
-        except gspread.exceptions.WorksheetNotFound:
-            audit_sheet = sh.add_worksheet(title="Audit Log", rows="1000", cols="1")
-            audit_sheet.update([["Audit Trail"]])
+    # Dictionary Update
+    is_new = True
+    if actual_cat in st.session_state.cloud_models:
+        if model in st.session_state.cloud_models[actual_cat]:
+            is_new = False
             
-        full_timestamp = datetime.now().strftime("%Y-%m-%d %I:%M %p")
-        if direction == "move":
-            log_entry = f"[{full_timestamp}] {st.session_state.current_user} MOVED {qty} of Model {model} (From: {loc} ➔ To: {to_loc})"
-        else:
-            log_entry = f"[{full_timestamp}] {st.session_state.current_user} {action_word.upper()} {qty} of Model {model} (Location: {loc})"
+    if is_new:
+        if actual_cat not in st.session_state.cloud_models:
+            st.session_state.cloud_models[actual_cat] = set()
+        st.session_state.cloud_models[actual_cat].add(model)
+        invalidate_catalog()
         
-        audit_sheet.append_row([log_entry])
-    except Exception:
-        pass
+        # We have to call Google for the new model anyway, so the queued audit rows go in the same request
+        try:
+            append_rows_to_sheets([("Dictionary", DICT_HEADER, [[actual_cat, model]]), ("Audit Log", AUDIT_HEADER, st.session_state.pending_rows)])
+            mark_audit_flushed()
+            st.session_state.last_flush = time.monotonic()
+            st.toast(f"☁️ '{model}' instantly saved to category '{actual_cat}'!")
+        except Exception as e:
+            # Retries already waited out the rate limits, so whatever is left is worth showing
+            st.toast(f"⚠️ Couldn't save '{model}' to the cloud dictionary: {e}")
+    else:
+        flush_pending()
     
     if direction == "add":
         st.success(f"✓ {action_word} {qty} {model} ({loc}) [Total: {st.session_state.data[key]}]")
@@ -319,143 +781,214 @@ def modify_inventory(direction):
         st.info(f"⇆ {action_word} {qty} {model} ({loc} ➔ {to_loc})")
 
 # --- Action Buttons ---
-btn_col1, btn_col2, btn_col3, btn_col4 = st.columns(4)
-with btn_col1:
-    if st.button("ADD (+)", use_container_width=True, type="primary"):
-        modify_inventory("add")
-        st.rerun() 
-with btn_col2:
-    if st.button("SUB (-)", use_container_width=True):
-        modify_inventory("sub")
-        st.rerun()
-with btn_col3:
-    if st.button("MOVE (⇆)", use_container_width=True):
-        modify_inventory("move")
-        st.rerun()
-with btn_col4:
+if add_clicked:
+    modify_inventory("add")
+if sub_clicked:
+    modify_inventory("sub")
+if move_clicked:
+    modify_inventory("move")
+# The list, history and sync status are drawn below with the new counts already, only a new
+# model or category makes the dropdowns above stale enough to need a second run
+if (add_clicked or sub_clicked or move_clicked) and 'catalog' not in st.session_state:
+    st.rerun()
+
+_, undo_col = st.columns([3, 1])
+with undo_col:
     if st.button("↺ Undo", use_container_width=True):
         if not st.session_state.history:
             st.warning("Nothing to undo!")
         else:
             last = st.session_state.history.pop()
+            key = (last["model"], last["loc"])
+            st.session_state.data.setdefault(key, 0)
             if last.get("action") == "Moved":
-                st.session_state.data[last["key"]] += last["qty"]
-                st.session_state.data[last["key_to"]] -= last["qty"]
+                key_to = (last["model"], last["to_loc"])
+                st.session_state.data.setdefault(key_to, 0)
+                st.session_state.data[key] += last["qty"]
+                st.session_state.data[key_to] -= last["qty"]
             else:
                 change = last["qty"] if last["action"] == "Added" else -last["qty"]
-                st.session_state.data[last["key"]] -= change
+                st.session_state.data[key] -= change
                 
             save_local_db()
+            drop_last_history_entry(get_hist_file())
             
             # --- NEW: Punch the Undo action through to the Cloud Audit Log! ---
-            try:
-                credentials = dict(st.secrets["gcp_service_account"])
-                gc = gspread.service_account_from_dict(credentials)
-                sh = gc.open("Warehouse Live Sync")
-                audit_sheet = sh.worksheet("Audit Log")
-                full_timestamp = datetime.now().strftime("%Y-%m-%d %I:%M %p")
+            # If the original row is still waiting in the queue, pulling it back out leaves nothing for Google to see
+            direction = {"Added": "add", "Removed": "sub", "Moved": "move"}.get(last.get("action"))
+            merge_key = (direction, last["model"], last["loc"], last.get("to_loc") if direction == "move" else None)
+            if not unqueue_count_audit(merge_key, last["qty"]):
+                full_timestamp = time.strftime("%Y-%m-%d %I:%M %p")
                 
                 if last.get("action") == "Moved":
                     undo_msg = f"[{full_timestamp}] ↺ UNDO: {st.session_state.current_user} reversed move of {last['qty']} x {last['model']} ({last['loc']} ➔ {last.get('to_loc')})"
                 else:
                     undo_msg = f"[{full_timestamp}] ↺ UNDO: {st.session_state.current_user} reversed {last['action'].lower()} of {last['qty']} x {last['model']} ({last['loc']})"
                 
-                audit_sheet.append_row([undo_msg])
-            except Exception:
-                pass
+                queue_audit_row(undo_msg)
+                flush_pending(force=True) # An undo is worth sending right away
             # ----------------------------------------------------------------
 
             st.info(f"↺ Undid last action for {last['model']}")
-            st.rerun()
-
-st.markdown("---")
 
-# --- Live Report Area ---
-st.subheader("📊 Live List (In Stock Only)")
+# Flushes queued audit rows on a timer, even if nobody touches the screen
+@st.fragment(run_every=FLUSH_EVERY_SECONDS)
+def cloud_sync_status():
+    flush_pending()
+    if st.session_state.pending_rows:
+        sync_col1, sync_col2 = st.columns([3, 1])
+        with sync_col1:
+            st.caption(f"☁️ {len(st.session_state.pending_rows)} change(s) waiting to sync to the Audit Log")
+        with sync_col2:
+            st.button("🔁 Sync Now", use_container_width=True, on_click=flush_pending, kwargs={"force": True})
 
-report_rows = []
+cloud_sync_status()
 
-# Gather unique models from both cloud categories and local data
-unique_models = set()
-model_to_cat = {}
-for cat, models in st.session_state.cloud_models.items():
-    unique_models.update(models)
-    for m in models:
-        model_to_cat[m] = cat
+st.markdown("---")
 
-for k in st.session_state.data.keys():
-    unique_models.add(k.split("|")[0])
+# --- Report Building ---
+REPORT_COLUMNS = ["_HiddenCat", "Model", "Warehouse", "Assembly", "Total", "Suspect (Bad)"]
 
-for m in sorted(list(unique_models)):
-    wh = st.session_state.data.get(f"{m}|Warehouse", 0)
-    asm = st.session_state.data.get(f"{m}|Assembly", 0)
-    susp = st.session_state.data.get(f"{m}|Suspect", 0)
-    total = wh + asm
-    
-    if total != 0 or susp != 0:
-        report_rows.append({
-            "_HiddenCat": model_to_cat.get(m, "Apk"), # Changed to a hidden background variable
-            "Model": m, 
-            "Warehouse": wh, 
-            "Assembly": asm, 
-            "Total": total, 
-            "Suspect (Bad)": susp
-        })
-
-if report_rows:
-    df = pd.DataFrame(report_rows)
-    df = df.sort_values(by=["_HiddenCat", "Model"])
-    
-    # Hide the category from the actual screen
-    display_df = df.drop(columns=["_HiddenCat"])
-    
-    search = st.text_input("🔍 Search Models to Filter:")
-    if search:
-        display_df = display_df[display_df["Model"].str.contains(search.upper())]
-        
-    st.dataframe(display_df, use_container_width=True, hide_index=True)
+# Typing in the search box reruns with the same counts, so the finished table comes straight from the cache
+# The token names the exact counts and catalog, so cache lookups skip hashing the (underscored) dicts
+@st.cache_data(show_spinner=False, max_entries=20)
+def build_report(token, _counts, _model_to_cat):
+    counts, model_to_cat = _counts, _model_to_cat
+    # One vectorized unstack over every (model, location) count instead of three lookups per model
+    if not counts:
+        return pd.DataFrame(columns=REPORT_COLUMNS)
+    # The MultiIndex stores each model/location name once and unstacks on small integer codes
+    index = pd.MultiIndex.from_tuples(list(counts.keys()), names=["Model", "Location"])
+    quantities = pd.to_numeric(pd.Series(list(counts.values()), index=index), errors="coerce").fillna(0).astype("int32")
     
-    now = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    pivot = quantities.unstack("Location", fill_value=0)
+    pivot = pivot.reindex(columns=LOCATIONS, fill_value=0).rename_axis(columns=None)
+    pivot["Total"] = pivot["Warehouse"] + pivot["Assembly"]
+    pivot = pivot[(pivot["Total"] != 0) | (pivot["Suspect"] != 0)]
     
-    # --- TABBED EXCEL DOWNLOAD FOR WORKERS ---
+    report = pivot.rename(columns={"Suspect": "Suspect (Bad)"}).reset_index()
+    # A handful of categories repeat down every row, so keep them as codes for the per-category filters and sort
+    report["_HiddenCat"] = report["Model"].map(model_to_cat).fillna("Apk").astype("category")
+    return report[REPORT_COLUMNS].sort_values(by=["_HiddenCat", "Model"])
+
+# The download files only change when the report does, so reruns reuse the bytes instead of re-encoding them
+@st.cache_data(show_spinner=False, max_entries=10)
+def export_report(df):
+    # One tab per category in Excel, or labelled sections in one CSV when openpyxl isn't installed
     try:
         output = io.BytesIO()
         with pd.ExcelWriter(output, engine='openpyxl') as writer:
             for cat in sorted(df['_HiddenCat'].unique()):
                 cat_df = df[df['_HiddenCat'] == cat].drop(columns=['_HiddenCat'])
                 cat_df.to_excel(writer, sheet_name=str(cat)[:31], index=False)
-        file_data = output.getvalue()
-        file_name = f"Inventory_{st.session_state.current_user}_{now}.xlsx"
-        mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        btn_label = "📥 DOWNLOAD EXCEL (SEPARATE TABS)"
+        return output.getvalue(), "xlsx"
     except ModuleNotFoundError:
-        csv_text = ""
+        # Write each section straight into one buffer instead of growing a string and encoding it again
+        output = io.BytesIO()
         for cat in sorted(df['_HiddenCat'].unique()):
             cat_df = df[df['_HiddenCat'] == cat].drop(columns=['_HiddenCat'])
-            csv_text += f"--- {cat.upper()} ---\n"
-            csv_text += cat_df.to_csv(index=False)
-            csv_text += "\n"
-        file_data = csv_text.encode('utf-8')
-        file_name = f"Inventory_{st.session_state.current_user}_{now}.csv"
-        mime_type = "text/csv"
-        btn_label = "📥 DOWNLOAD CSV (SEPARATED)"
-
-    st.download_button(
-        label=btn_label,
-        data=file_data,
-        file_name=file_name,
-        mime=mime_type,
-    )
-else:
-    st.info("No items currently in stock. Add items above.")
+            output.write(f"--- {cat.upper()} ---\n".encode('utf-8'))
+            cat_df.to_csv(output, index=False, encoding='utf-8')
+            output.write(b"\n")
+        return output.getvalue(), "csv"
+
+@st.cache_data(show_spinner=False, max_entries=10)
+def export_report_parquet(df):
+    # Compact columnar copy for spreadsheets/BI tools that read Parquet, None when pyarrow isn't installed
+    try:
+        output = io.BytesIO()
+        df.rename(columns={"_HiddenCat": "Category"}).to_parquet(output, index=False, compression="zstd")
+        return output.getvalue()
+    except ImportError:
+        return None
+
+@st.cache_data(show_spinner=False, max_entries=20)
+def model_search_index(token, _models):
+    # Uppercased once per report, plus the row order that sorts them, so keystrokes never touch the strings again
+    upper = np.char.upper(_models.to_numpy(dtype=str))
+    order = np.argsort(upper, kind="stable")
+    return upper, upper[order], order
+
+def filter_models(display_df, needle, token):
+    upper, sorted_upper, order = model_search_index(token, display_df["Model"])
+    # Scanners type the start of a model number, so a binary search on the sorted names finds the matches;
+    # a leading * or ? falls back to matching anywhere in the name
+    if needle[0] in "*?":
+        needle = needle.lstrip("*?")
+        return display_df[np.char.find(upper, needle) >= 0]
+    lo = sorted_upper.searchsorted(needle)
+    hi = sorted_upper.searchsorted(needle + "\uffff")
+    return display_df.iloc[np.sort(order[lo:hi])] # Back in report order
+
+# --- Live Report Area ---
+st.subheader("📊 Live List (In Stock Only)")
+
+# Typing in the search box only reruns this section instead of the whole workspace
+@st.fragment
+def live_report():
+    # Fresh or fully zeroed workspaces skip hashing the counts into the report cache altogether
+    if not any(st.session_state.data.values()):
+        st.info("No items currently in stock. Add items above.")
+        return
+    catalog = get_catalog()
+    report_token = (st.session_state.data_token, catalog["token"])
+    df = build_report(report_token, st.session_state.data, catalog["model_to_cat"])
+
+    if not df.empty:
+        # Hide the category from the actual screen
+        display_df = df.drop(columns=["_HiddenCat"])
+    
+        search = st.text_input("🔍 Search Models to Filter:", help="Matches the start of the model number. Begin with * to match anywhere in it.")
+        needle = search.strip().upper()
+        if needle: # A box holding only spaces would otherwise filter every row out
+            display_df = filter_models(display_df, needle, report_token)
+        
+        st.dataframe(display_df, use_container_width=True, hide_index=True)
+    
+        now = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    
+        # --- TABBED EXCEL DOWNLOAD FOR WORKERS ---
+        file_data, file_ext = export_report(df)
+        file_name = f"Inventory_{st.session_state.current_user}_{now}.{file_ext}"
+        if file_ext == "xlsx":
+            mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            btn_label = "📥 DOWNLOAD EXCEL (SEPARATE TABS)"
+        else:
+            mime_type = "text/csv"
+            btn_label = "📥 DOWNLOAD CSV (SEPARATED)"
+
+        st.download_button(
+            label=btn_label,
+            data=file_data,
+            file_name=file_name,
+            mime=mime_type,
+        )
+        
+        parquet_data = export_report_parquet(df)
+        if parquet_data is not None:
+            st.download_button(
+                label="📥 DOWNLOAD PARQUET",
+                data=parquet_data,
+                file_name=f"Inventory_{st.session_state.current_user}_{now}.parquet",
+                mime="application/octet-stream",
+            )
+    else:
+        st.info("No items currently in stock. Add items above.")
+
+live_report()
+
+catalog = get_catalog()
 
 with st.expander("Show Recent History Log"):
     if st.session_state.history:
-        for item in reversed(st.session_state.history[-10:]):
+        # Walk the deque backwards in place instead of copying all of it to show ten lines
+        lines = []
+        for item in islice(reversed(st.session_state.history), 10):
             if item.get("action") == "Moved":
-                st.text(f"[{item['timestamp']}] {item['action']} {item['qty']} x {item['model']} ({item['loc']} ➔ {item.get('to_loc')})")
+                lines.append(f"[{item['timestamp']}] {item['action']} {item['qty']} x {item['model']} ({item['loc']} ➔ {item.get('to_loc')})")
             else:
-                st.text(f"[{item['timestamp']}] {item['action']} {item['qty']} x {item['model']} ({item['loc']})")
+                lines.append(f"[{item['timestamp']}] {item['action']} {item['qty']} x {item['model']} ({item['loc']})")
+        st.text("\n".join(lines)) # One element on the page instead of ten
     else:
         st.text("No history yet.")
 
@@ -472,7 +1005,7 @@ with reset_col1:
             if st.button("Yes, Reset All Counts", use_container_width=True):
                 for key in st.session_state.data:
                     st.session_state.data[key] = 0
-                st.session_state.history = []
+                st.session_state.history = deque(maxlen=HISTORY_LIMIT)
                 save_local_db()
                 
                 for file in glob.glob("inventory_data_*.json"):
@@ -487,18 +1020,20 @@ with reset_col1:
                         pass
                 for file in glob.glob("inventory_history_*.json"):
                     try:
-                        with open(file, "w") as f:
-                            json.dump([], f)
+                        # An empty file is an empty history; a "[]" would get the next appended entry glued onto it
+                        open(file, "w").close()
                     except:
                         pass
+                invalidate_all_user_data()
                 st.rerun()
         else:
             st.warning("Are you sure? This sets all your personal counts to 0.")
             if st.button("Yes, Reset My Counts", use_container_width=True):
                 for key in st.session_state.data:
                     st.session_state.data[key] = 0
-                st.session_state.history = []  
+                st.session_state.history = deque(maxlen=HISTORY_LIMIT)
                 save_local_db()
+                write_history_file(get_hist_file(), [])
                 st.rerun()
 
 with reset_col2:
@@ -511,7 +1046,7 @@ with reset_col2:
             # The button stays greyed out and unclickable until the text matches exactly
             if st.button("Yes, Wipe My Data", use_container_width=True, type="primary", disabled=(confirm_wipe != "WIPE EVERYTHING")):
                 st.session_state.data = {}
-                st.session_state.history = {}
+                st.session_state.history = deque(maxlen=HISTORY_LIMIT)
                 
                 for file in glob.glob("inventory_data_*.json"):
                     try: os.remove(file)
@@ -521,6 +1056,7 @@ with reset_col2:
                     except: pass
                 
                 save_local_db() 
+                invalidate_all_user_data()
                 st.rerun()
 
 st.markdown("---")
@@ -532,16 +1068,15 @@ if st.session_state.current_user == "Admin":
         move_col1, move_col2, move_col3 = st.columns([2, 2, 1])
         
         with move_col1:
-            all_known_models = sorted(list(unique_models))
-            model_to_move = st.selectbox("Select model:", ["-- Select --"] + all_known_models, key="move_mod")
+            model_to_move = st.selectbox("Select model:", catalog["model_pick_options"], key="move_mod")
             
         with move_col2:
-            target_cat = st.selectbox("Select new category:", ["-- Select --"] + categories, key="move_cat")
+            target_cat = st.selectbox("Select new category:", catalog["category_pick_options"], key="move_cat")
             
         with move_col3:
             st.markdown("<br>", unsafe_allow_html=True) # Aligns the button with the dropdowns
             if st.button("Move", use_container_width=True, type="primary"):
-                if model_to_move != "-- Select --" and target_cat != "-- Select --":
+                if model_to_move != SELECT_PLACEHOLDER and target_cat != SELECT_PLACEHOLDER:
                     # 1. Remove from all old categories
                     for c in list(st.session_state.cloud_models.keys()):
                         if model_to_move in st.session_state.cloud_models[c]:
@@ -551,19 +1086,11 @@ if st.session_state.current_user == "Admin":
                     if target_cat not in st.session_state.cloud_models:
                         st.session_state.cloud_models[target_cat] = set()
                     st.session_state.cloud_models[target_cat].add(model_to_move)
+                    invalidate_catalog()
                     
-                    # 3. Force a cloud sync so it remembers forever
+                    # 3. Force a cloud sync so it remembers forever (the newest row for a model wins on load)
                     try:
-                        credentials = dict(st.secrets["gcp_service_account"])
-                        gc = gspread.service_account_from_dict(credentials)
-                        sh = gc.open("Warehouse Live Sync")
-                        dict_sheet = sh.worksheet("Dictionary")
-                        dict_sheet.clear()
-                        dict_upload = [["Category", "Model"]]
-                        for c, models_in_cat in st.session_state.cloud_models.items():
-                            for m_val in models_in_cat:
-                                dict_upload.append([c, m_val])
-                        dict_sheet.update(dict_upload)
+                        append_sheet_rows("Dictionary", DICT_HEADER, [[target_cat, model_to_move]])
                         st.success(f"✅ Model '{model_to_move}' successfully moved to '{target_cat}'!")
                         st.rerun()
                     except Exception as e:
@@ -575,13 +1102,12 @@ if st.session_state.current_user == "Admin":
         st.write("Select a model to permanently remove from memory:")
         del_col1, del_col2 = st.columns([3, 1])
         with del_col1:
-            all_known_models = sorted(list(unique_models))
-            model_to_delete = st.selectbox("Select model:", ["-- Select --"] + all_known_models, label_visibility="collapsed")
+            model_to_delete = st.selectbox("Select model:", catalog["model_pick_options"], label_visibility="collapsed")
         with del_col2:
             if st.button("Delete Model", use_container_width=True, type="primary"):
-                if model_to_delete and model_to_delete != "-- Select --":
+                if model_to_delete and model_to_delete != SELECT_PLACEHOLDER:
                     # 1. Erase the local inventory counts
-                    keys_to_delete = [k for k in st.session_state.data.keys() if k.startswith(f"{model_to_delete}|")]
+                    keys_to_delete = [k for k in st.session_state.data.keys() if k[0] == model_to_delete]
                     for k in keys_to_delete:
                         del st.session_state.data[k]
                     save_local_db()
@@ -600,24 +1126,17 @@ if st.session_state.current_user == "Admin":
                                     json.dump(other_data, f)
                         except:
                             pass
+                    invalidate_all_user_data()
                             
                     # 2. Erase the model from the Cloud Dictionary memory
                     for c in list(st.session_state.cloud_models.keys()):
                         if model_to_delete in st.session_state.cloud_models[c]:
                             st.session_state.cloud_models[c].remove(model_to_delete)
+                    invalidate_catalog()
                             
-                    # 3. Punch through to the Cloud! Instantly update the Google Sheet so it doesn't come back
+                    # 3. Punch through to the Cloud! Instantly drop its rows from the Google Sheet so it doesn't come back
                     try:
-                        credentials = dict(st.secrets["gcp_service_account"])
-                        gc = gspread.service_account_from_dict(credentials)
-                        sh = gc.open("Warehouse Live Sync")
-                        dict_sheet = sh.worksheet("Dictionary")
-                        dict_sheet.clear()
-                        dict_upload = [["Category", "Model"]]
-                        for c, models_in_cat in st.session_state.cloud_models.items():
-                            for m_val in models_in_cat:
-                                dict_upload.append([c, m_val])
-                        dict_sheet.update(dict_upload)
+                        delete_sheet_rows("Dictionary", DICT_HEADER, model_to_delete, column=2)
                         st.success(f"✅ '{model_to_delete}' completely erased from counts and dictionary!")
                     except Exception as e:
                         st.error(f"Failed to erase from cloud: {e}")
@@ -626,24 +1145,19 @@ if st.session_state.current_user == "Admin":
 
     with st.expander("❌ Delete a Category"):
         st.write("Remove a category. Any models inside it will be safely moved to the default 'Apk' category so no inventory is lost.")
-        cat_to_del = st.selectbox("Select Category to Delete", ["-- Select --"] + [c for c in categories if c != "Apk"])
+        cat_to_del = st.selectbox("Select Category to Delete", catalog["deletable_category_options"])
         if st.button("Delete Category", use_container_width=True, type="primary"):
-            if cat_to_del != "-- Select --":
+            if cat_to_del != SELECT_PLACEHOLDER:
                 if cat_to_del in st.session_state.cloud_models:
-                    st.session_state.cloud_models["Apk"].update(st.session_state.cloud_models[cat_to_del])
+                    moved_models = st.session_state.cloud_models[cat_to_del]
+                    st.session_state.cloud_models["Apk"].update(moved_models)
                     del st.session_state.cloud_models[cat_to_del]
+                    invalidate_catalog()
                     
                     try:
-                        credentials = dict(st.secrets["gcp_service_account"])
-                        gc = gspread.service_account_from_dict(credentials)
-                        sh = gc.open("Warehouse Live Sync")
-                        dict_sheet = sh.worksheet("Dictionary")
-                        dict_sheet.clear()
-                        dict_upload = [["Category", "Model"]]
-                        for c, models_in_cat in st.session_state.cloud_models.items():
-                            for m_val in models_in_cat:
-                                dict_upload.append([c, m_val])
-                        dict_sheet.update(dict_upload)
+                        # The newest row for a model wins on load, so re-filing them under Apk is enough
+                        if moved_models:
+                            append_sheet_rows("Dictionary", DICT_HEADER, [["Apk", m] for m in sorted(moved_models)])
                         st.success(f"✅ Category '{cat_to_del}' deleted. Its models were safely moved to 'Apk'.")
                         st.rerun()
                     except Exception as e:
@@ -654,13 +1168,12 @@ if st.session_state.current_user == "Admin":
         if st.button("Erase Cloud Audit Log", use_container_width=True, type="primary"):
             try:
                 with st.spinner("Connecting to Google to wipe the log..."):
-                    credentials = dict(st.secrets["gcp_service_account"])
-                    gc = gspread.service_account_from_dict(credentials)
-                    sh = gc.open("Warehouse Live Sync")
                     try:
-                        audit_sheet = sh.worksheet("Audit Log")
-                        audit_sheet.clear()
-                        audit_sheet.update([["Audit Trail"]]) 
+                        # Look the tab up directly, get_worksheet would create it just to wipe it
+                        if "Audit Log" not in st.session_state.get('worksheets', {}):
+                            audit_sheet = retry_sheets(sheets_request)(get_spreadsheet().worksheet, "Audit Log")
+                            st.session_state.setdefault('worksheets', {})["Audit Log"] = audit_sheet
+                        replace_sheet_rows("Audit Log", AUDIT_HEADER, [])
                         st.success("✅ The Cloud Audit Log has been completely wiped clean!")
                     except gspread.exceptions.WorksheetNotFound:
                         st.info("No Audit Log exists in the cloud yet, nothing to wipe.")
@@ -673,19 +1186,18 @@ if st.session_state.current_user == "Admin":
         
         with acc_col1:
             st.markdown("**Add New User**")
-            new_user = st.text_input("New Username").strip()
-            new_pwd = st.text_input("New Password").strip()
-            if st.button("Add User", type="primary", use_container_width=True):
+            # A form so typing the name and password doesn't rerun the whole admin page per keystroke
+            with st.form("add_user", clear_on_submit=True, enter_to_submit=False):
+                new_user = st.text_input("New Username").strip()
+                new_pwd = st.text_input("New Password").strip()
+                add_user_clicked = st.form_submit_button("Add User", type="primary", use_container_width=True)
+            if add_user_clicked:
                 if new_user and new_pwd:
                     if new_user in st.session_state.USERS:
                         st.warning(f"User '{new_user}' already exists!")
                     else:
                         try:
-                            credentials = dict(st.secrets["gcp_service_account"])
-                            gc = gspread.service_account_from_dict(credentials)
-                            sh = gc.open("Warehouse Live Sync")
-                            users_sheet = sh.worksheet("Users")
-                            users_sheet.append_row([new_user, new_pwd])
+                            append_sheet_rows("Users", USERS_HEADER, [[new_user, new_pwd]])
                             st.session_state.USERS[new_user] = new_pwd
                             st.success(f"✅ User '{new_user}' added successfully!")
                             st.rerun()
@@ -700,24 +1212,12 @@ if st.session_state.current_user == "Admin":
             deletable_users = [u for u in st.session_state.USERS.keys() if u not in base_users]
             
             if deletable_users:
-                user_to_delete = st.selectbox("Select Worker to Remove", ["-- Select --"] + deletable_users, label_visibility="collapsed")
+                user_to_delete = st.selectbox("Select Worker to Remove", (SELECT_PLACEHOLDER, *deletable_users), label_visibility="collapsed")
                 if st.button("Delete User", use_container_width=True):
-                    if user_to_delete != "-- Select --":
+                    if user_to_delete != SELECT_PLACEHOLDER:
                         try:
-                            credentials = dict(st.secrets["gcp_service_account"])
-                            gc = gspread.service_account_from_dict(credentials)
-                            sh = gc.open("Warehouse Live Sync")
-                            users_sheet = sh.worksheet("Users")
-                            
                             del st.session_state.USERS[user_to_delete]
-                            
-                            cloud_upload = [["Username", "Password"]]
-                            for u, p in st.session_state.USERS.items():
-                                if u not in base_users:
-                                    cloud_upload.append([u, p])
-                                    
-                            users_sheet.clear()
-                            users_sheet.update(cloud_upload)
+                            delete_sheet_rows("Users", USERS_HEADER, user_to_delete)
                             st.success(f"✅ User '{user_to_delete}' has been removed.")
                             st.rerun()
                         except Exception as e:
@@ -730,44 +1230,18 @@ if st.session_state.current_user == "Admin":
     st.markdown("---")
     st.header("👑 Admin Master Dashboard")
     st.write("Aggregated totals combined from all users' personal workspaces.")
+    if st.button("🔄 Refresh Totals From All Workspaces"):
+        invalidate_all_user_data()
     
-    master_data = {}
-    for file in glob.glob("inventory_data_*.json"):
-        with open(file, "r") as f:
-            try:
-                user_data = json.load(f)
-                for k, v in user_data.items():
-                    master_data[k] = master_data.get(k, 0) + v
-            except:
-                pass
+    master_data = master_totals()
                 
-    master_rows = []
-    master_models = sorted(list(set([k.split("|")[0] for k in master_data.keys()])))
-    
-    master_model_to_cat = {}
-    for cat, models in st.session_state.cloud_models.items():
-        for m in models:
-            master_model_to_cat[m] = cat
-    
-    for m in master_models:
-        wh = master_data.get(f"{m}|Warehouse", 0)
-        asm = master_data.get(f"{m}|Assembly", 0)
-        susp = master_data.get(f"{m}|Suspect", 0)
-        total = wh + asm
-        
-        if total != 0 or susp != 0:
-            master_rows.append({
-                "_HiddenCat": master_model_to_cat.get(m, "Apk"), # Changed to hidden
-                "Model": m, 
-                "Warehouse": wh, 
-                "Assembly": asm, 
-                "Total": total, 
-                "Suspect (Bad)": susp
-            })
+    if any(master_data.values()):
+        catalog = get_catalog()
+        df_master = build_report(("master", st.session_state.all_user_data_token, catalog["token"]), master_data, catalog["model_to_cat"])
+    else:
+        df_master = pd.DataFrame(columns=REPORT_COLUMNS)
             
-    if master_rows:
-        df_master = pd.DataFrame(master_rows)
-        df_master = df_master.sort_values(by=["_HiddenCat", "Model"])
+    if not df_master.empty:
         
         # --- 🦅 THE EAGLE EYE (VISUAL ANALYTICS) ---
         st.markdown("### 🦅 Eagle Eye Dashboard")
@@ -795,25 +1269,12 @@ if st.session_state.current_user == "Admin":
         now = datetime.now().strftime("%Y-%m-%d_%H-%M")
         
         # --- NEW: MASTER TABBED EXCEL DOWNLOAD ---
-        try:
-            output_master = io.BytesIO()
-            with pd.ExcelWriter(output_master, engine='openpyxl') as writer:
-                for cat in sorted(df_master['_HiddenCat'].unique()):
-                    cat_df = df_master[df_master['_HiddenCat'] == cat].drop(columns=['_HiddenCat'])
-                    cat_df.to_excel(writer, sheet_name=str(cat)[:31], index=False)
-            file_data_master = output_master.getvalue()
-            file_name_master = f"Inventory_MASTER_{now}.xlsx"
+        file_data_master, file_ext_master = export_report(df_master)
+        file_name_master = f"Inventory_MASTER_{now}.{file_ext_master}"
+        if file_ext_master == "xlsx":
             mime_type_master = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             btn_label_master = "📥 DOWNLOAD MASTER EXCEL (TABS)"
-        except ModuleNotFoundError:
-            csv_text_master = ""
-            for cat in sorted(df_master['_HiddenCat'].unique()):
-                cat_df = df_master[df_master['_HiddenCat'] == cat].drop(columns=['_HiddenCat'])
-                csv_text_master += f"--- {cat.upper()} ---\n"
-                csv_text_master += cat_df.to_csv(index=False)
-                csv_text_master += "\n"
-            file_data_master = csv_text_master.encode('utf-8')
-            file_name_master = f"Inventory_MASTER_{now}.csv"
+        else:
             mime_type_master = "text/csv"
             btn_label_master = "📥 DOWNLOAD MASTER CSV (SEPARATED)"
         
@@ -828,47 +1289,36 @@ if st.session_state.current_user == "Admin":
                 type="primary" 
             )
             
+            parquet_master = export_report_parquet(df_master)
+            if parquet_master is not None:
+                st.download_button(
+                    label="📥 DOWNLOAD MASTER PARQUET",
+                    data=parquet_master,
+                    file_name=f"Inventory_MASTER_{now}.parquet",
+                    mime="application/octet-stream",
+                )
+            
         with col_cloud:
             if st.button("☁️ Sync to Google Sheets", use_container_width=True):
                 with st.spinner("Syncing to the Cloud..."):
                     try:
-                        credentials = dict(st.secrets["gcp_service_account"])
-                        gc = gspread.service_account_from_dict(credentials)
-                        sh = gc.open("Warehouse Live Sync")
-                        
                         today_str = datetime.now().strftime("%Y-%m-%d")
                         snapshot_title = f"Snapshot: {today_str}"
                         
-                        try:
-                            worksheet = sh.worksheet(snapshot_title)
-                        except gspread.exceptions.WorksheetNotFound:
-                            worksheet = sh.add_worksheet(title=snapshot_title, rows="1000", cols="5")
-                        
-                        worksheet.clear()
                         # Make sure we don't upload the hidden category to the daily snapshot!
-                        data_to_upload = [display_df_master.columns.values.tolist()] + display_df_master.astype(str).values.tolist()
-                        worksheet.update(data_to_upload)
+                        replace_sheet_rows(snapshot_title, display_df_master.columns.values.tolist(), display_df_master.astype(str).values.tolist())
                         
-                        all_sheets = sh.worksheets()
+                        sh = get_spreadsheet()
+                        all_sheets = retry_sheets(sheets_request)(sh.worksheets)
                         snapshot_sheets = [ws for ws in all_sheets if ws.title.startswith("Snapshot: ")]
                         snapshot_sheets.sort(key=lambda ws: ws.title)
                         
                         while len(snapshot_sheets) > 2:
                             ws_to_delete = snapshot_sheets.pop(0)
-                            sh.del_worksheet(ws_to_delete)
+                            retry_sheets(sheets_request)(sh.del_worksheet, ws_to_delete)
+                            st.session_state.worksheets.pop(ws_to_delete.title, None)
                         
-                        try:
-                            dict_sheet = sh.worksheet("Dictionary")
-                        except gspread.exceptions.WorksheetNotFound:
-                            dict_sheet = sh.add_worksheet(title="Dictionary", rows="1000", cols="2")
-
-                        dict_sheet.clear()
-                        dict_upload = [["Category", "Model"]]
-                        for cat, models_in_cat in st.session_state.cloud_models.items():
-                            for m_val in models_in_cat:
-                                dict_upload.append([cat, m_val])
-                                
-                        dict_sheet.update(dict_upload)
+                        push_dictionary()
                         
                         st.success(f"✅ Successfully updated '{snapshot_title}' and Cloud Dictionary!")
                         